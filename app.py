@@ -2,6 +2,7 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import requests
+from requests.adapters import HTTPAdapter
 import firebase_admin
 from firebase_admin import credentials, firestore
 from firebase_admin import firestore as admin_firestore
@@ -11,7 +12,33 @@ import base64
 import json
 import time
 import random
-
+import logging
+import functools
+import threading
+import queue
+import atexit
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Log records are queued and written to stderr by a listener thread, so request
+# and send-pool threads never block on the stream lock
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+_log_queue = queue.Queue(-1)
+_log_listener = QueueListener(_log_queue, _log_stream)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+# Bare message here - the listener's handler adds timestamp and level
+_log_queue_handler = QueueHandler(_log_queue)
+_log_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+
+logging.basicConfig(
+    level=os.environ.get('LOG_LEVEL', 'INFO'),
+    handlers=[_log_queue_handler]
+)
+log = logging.getLogger(__name__)
 
 app = Flask(__name__)
 CORS(app)
@@ -35,19 +62,19 @@ try:
     firebase_creds_base64 = os.environ.get('FIREBASE_CREDENTIALS_BASE64')
 
     if firebase_creds_base64:
-        print("🔐 Using Firebase credentials from environment variable")
+        log.info("Using Firebase credentials from environment variable")
         cred_json = base64.b64decode(firebase_creds_base64)
         cred_dict = json.loads(cred_json)
         cred = credentials.Certificate(cred_dict)
     else:
-        print("📁 Using Firebase credentials from file")
+        log.info("Using Firebase credentials from file")
         cred = credentials.Certificate("firebase-credentials.json")
 
     firebase_admin.initialize_app(cred)
     db = firestore.client()
-    print("✅ Firebase connected!")
+    log.info("Firebase connected")
 except Exception as e:
-    print(f"❌ Firebase error: {e}")
+    log.error("Firebase error: %s", e)
     db = None
 
 
@@ -55,12 +82,63 @@ except Exception as e:
 # Helper Functions
 # ============================================================
 
+def ttl_cache(seconds=300, maxsize=128):
+    """
+    Cache a function's result per positional args for `seconds`.
+
+    Process-local (each gunicorn worker has its own copy). Expired entries are
+    dropped when looked up, and the oldest entry is evicted once `maxsize` is
+    reached, so arbitrary request-supplied keys can't grow it without bound.
+    """
+    def decorator(func):
+        cache = {}
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            now = time.monotonic()
+            with lock:
+                hit = cache.get(args)
+                if hit is not None:
+                    if now - hit[1] < seconds:
+                        return hit[0]
+                    del cache[args]
+
+            value = func(*args)
+
+            with lock:
+                if len(cache) >= maxsize:
+                    # Insertion order == age, so the first key is the oldest entry
+                    cache.pop(next(iter(cache)))
+                cache[args] = (value, now)
+            return value
+
+        return wrapper
+
+    return decorator
+
+
+# Characters stripped from phone numbers, applied in a single translate() pass
+_PHONE_STRIP = str.maketrans('', '', '+ -')
+
+
 def clean_phone_number(phone):
     """Remove + sign and clean phone number"""
     if not phone:
         return None
-    cleaned = phone.replace('+', '').replace(' ', '').replace('-', '')
-    return cleaned
+    return phone.translate(_PHONE_STRIP)
+
+
+# Shared session keeps TCP/TLS connections to graph.facebook.com warm across sends.
+# max_retries=0: send_text has its own backoff, urllib3 retries would stack on top.
+_wa_session = requests.Session()
+_wa_session.mount('https://', HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=0))
+
+_WA_URL = f"https://graph.facebook.com/v21.0/{PHONE_NUMBER_ID}/messages"
+_WA_HEADERS = {
+    "Authorization": f"Bearer {WHATSAPP_TOKEN}",
+    "Content-Type": "application/json"
+}
 
 
 def send_text(to_number, message, restaurant_id=None):
@@ -77,12 +155,6 @@ def send_text(to_number, message, restaurant_id=None):
     """
     clean_number = clean_phone_number(to_number)
 
-    url = f"https://graph.facebook.com/v21.0/{PHONE_NUMBER_ID}/messages"
-    headers = {
-        "Authorization": f"Bearer {WHATSAPP_TOKEN}",
-        "Content-Type": "application/json"
-    }
-
     payload = {
         "messaging_product": "whatsapp",
         "to": clean_number,
@@ -96,15 +168,15 @@ def send_text(to_number, message, restaurant_id=None):
 
     for attempt in range(max_retries):
         try:
-            response = requests.post(url, json=payload, headers=headers, timeout=10)
+            response = _wa_session.post(_WA_URL, json=payload, headers=_WA_HEADERS, timeout=10)
 
-            print(f"📤 [Attempt {attempt + 1}] Sent to {clean_number}: {response.status_code}")
+            log.debug("[Attempt %d] Sent to %s: %s", attempt + 1, clean_number, response.status_code)
 
             if response.status_code == 200:
                 result = response.json()
                 return result
 
-            print(f"❌ WhatsApp API Error: {response.text}")
+            log.error("WhatsApp API error: %s", response.text)
 
             # Don't retry client errors (4xx except rate limits)
             if 400 <= response.status_code < 500 and response.status_code != 429:
@@ -113,20 +185,20 @@ def send_text(to_number, message, restaurant_id=None):
             # Retry on 5xx or 429 (rate limit)
             if attempt < max_retries - 1:
                 delay = base_delay * (2 ** attempt)
-                print(f"⏳ Retrying in {delay}s...")
+                log.warning("Retrying in %ss...", delay)
                 time.sleep(delay)
             else:
                 return {"error": response.text}
 
         except requests.exceptions.Timeout:
-            print(f"⏱️ Timeout on attempt {attempt + 1}")
+            log.warning("Timeout on attempt %d", attempt + 1)
             if attempt < max_retries - 1:
                 time.sleep(base_delay * (2 ** attempt))
             else:
                 return {"error": "Request timeout"}
 
         except requests.exceptions.RequestException as e:
-            print(f"🔌 Network error: {e}")
+            log.warning("Network error: %s", e)
             if attempt < max_retries - 1:
                 time.sleep(base_delay * (2 ** attempt))
             else:
@@ -135,16 +207,38 @@ def send_text(to_number, message, restaurant_id=None):
     return {"error": "Max retries exceeded"}
 
 
+# Background pool for outbound WhatsApp calls so request threads don't wait on graph.facebook.com
+_send_pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix='wa-send')
+
+
+# Template campaign sends share one pool per worker process, so concurrent
+# campaigns don't stack their rates against Meta's per-number limits. Each
+# gunicorn worker process still has its own pool.
+CAMPAIGN_WORKERS = 20
+_campaign_pool = ThreadPoolExecutor(max_workers=CAMPAIGN_WORKERS, thread_name_prefix='wa-campaign')
+
+# Sends a single campaign may have queued or in flight at once
+CAMPAIGN_QUEUE_DEPTH = CAMPAIGN_WORKERS * 2
+
+
+def _log_send_failure(future):
+    """Done-callback for send_text_async - callers drop the Future, so log errors here"""
+    err = future.exception()
+    if err is not None:
+        log.error("Background send failed: %s", err, exc_info=err)
+
+
+def send_text_async(to_number, message, restaurant_id=None):
+    """Queue send_text on the background pool; returns a Future with its result"""
+    future = _send_pool.submit(send_text, to_number, message, restaurant_id)
+    future.add_done_callback(_log_send_failure)
+    return future
+
+
 def send_template_message(phone_number, template_name, params):
     """Send WhatsApp template message (no 24-hour limit)"""
     clean_number = clean_phone_number(phone_number)
 
-    url = f"https://graph.facebook.com/v21.0/{PHONE_NUMBER_ID}/messages"
-    headers = {
-        "Authorization": f"Bearer {WHATSAPP_TOKEN}",
-        "Content-Type": "application/json"
-    }
-
     payload = {
         "messaging_product": "whatsapp",
         "to": clean_number,
@@ -161,14 +255,26 @@ def send_template_message(phone_number, template_name, params):
         }
     }
 
-    response = requests.post(url, json=payload, headers=headers)
-    print(f"[TEMPLATE SEND] → {clean_number}: {response.status_code}")
+    response = _wa_session.post(_WA_URL, json=payload, headers=_WA_HEADERS, timeout=10)
+    log.debug("[TEMPLATE SEND] %s: %s", clean_number, response.status_code)
     return response.json()
 
 
+# Fields fetched per segment customer - everything else is left on the server.
+# Campaigns only read phone_number, but registered_at must stay: the recent/older
+# range filters order by it, and if the long-lived stream is retried the client
+# resumes from start_after(last_snapshot), which needs every order-by field.
+SEGMENT_FIELDS = ['phone_number', 'registered_at']
+
+
 def get_customers_by_segment(segment, restaurant_id=None):
     """
-    Get customers based on segment type
+    Stream customers based on segment type (yields dicts as Firestore returns them)
+
+    Only SEGMENT_FIELDS are fetched for each customer (phone_number, plus the
+    registered_at order-by field needed to resume the stream). Firestore errors
+    are not caught here - they can surface mid-stream, and callers must be able
+    to tell them apart from the end of the segment.
 
     Segments:
     - all: All customers
@@ -176,97 +282,88 @@ def get_customers_by_segment(segment, restaurant_id=None):
     - older: Registered 30+ days ago
     """
     if not db:
-        return []
+        return
 
     rest_id = restaurant_id or RESTAURANT_ID
 
-    try:
-        if segment == 'recent':
-            thirty_days_ago = datetime.now(timezone.utc) - timedelta(days=30)
-            customers_ref = db.collection('customers')\
-                .where('restaurant_id', '==', rest_id)\
-                .where('registered_at', '>=', thirty_days_ago)\
-                .stream()
-
-        elif segment == 'older':
-            thirty_days_ago = datetime.now(timezone.utc) - timedelta(days=30)
-            customers_ref = db.collection('customers')\
-                .where('restaurant_id', '==', rest_id)\
-                .where('registered_at', '<', thirty_days_ago)\
-                .stream()
-
-        else:  # 'all' or default
-            customers_ref = db.collection('customers')\
-                .where('restaurant_id', '==', rest_id)\
-                .stream()
-
-        # Convert to list
-        customers = []
-        for customer in customers_ref:
-            customers.append(customer.to_dict())
-
-        return customers
+    if segment == 'recent':
+        thirty_days_ago = datetime.now(timezone.utc) - timedelta(days=30)
+        customers_ref = db.collection('customers')\
+            .where('restaurant_id', '==', rest_id)\
+            .where('registered_at', '>=', thirty_days_ago)\
+            .select(SEGMENT_FIELDS)\
+            .stream()
 
-    except Exception as e:
-        print(f"❌ Error getting customers: {e}")
-        return []
+    elif segment == 'older':
+        thirty_days_ago = datetime.now(timezone.utc) - timedelta(days=30)
+        customers_ref = db.collection('customers')\
+            .where('restaurant_id', '==', rest_id)\
+            .where('registered_at', '<', thirty_days_ago)\
+            .select(SEGMENT_FIELDS)\
+            .stream()
+
+    else:  # 'all' or default
+        customers_ref = db.collection('customers')\
+            .where('restaurant_id', '==', rest_id)\
+            .select(SEGMENT_FIELDS)\
+            .stream()
+
+    for customer in customers_ref:
+        yield customer.to_dict()
 
 
 # ============================================================
 # Onboarding Functions
 # ============================================================
 
-def get_customer_by_phone_only(phone_number, restaurant_id):
-    """Get customer by phone and restaurant"""
-    if not db:
-        return None
+@ttl_cache(seconds=300)
+def get_restaurant(restaurant_id):
+    """Get restaurant doc as dict (None if missing), cached for 5 minutes"""
+    rest_doc = db.collection('restaurants').document(restaurant_id).get()
+    return rest_doc.to_dict() if rest_doc.exists else None
 
-    phone = clean_phone_number(phone_number)
-    customer_id = f"{phone}_{restaurant_id}"
-    customer_ref = db.collection('customers').document(customer_id)
-    customer = customer_ref.get()
 
-    if customer.exists:
-        print(f"✅ Found existing customer: {customer_id}")
-        return customer.to_dict()
+def get_customer_and_signup_code(phone, restaurant_id):
+    """Get customer and restaurant's active signup code in one get_all round trip
 
-    print(f"ℹ️ No customer found: {customer_id}")
-    return None
+    phone must already be cleaned (the webhook cleans it once on entry)
+    """
+    if not db:
+        return None, None
 
+    customer_id = f"{phone}_{restaurant_id}"
+    customer_ref = db.collection('customers').document(customer_id)
+    rest_ref = db.collection('restaurants').document(restaurant_id)
 
-def get_restaurant_code(restaurant_id):
-    """Get active signup code for restaurant"""
-    if not db:
-        print("❌ Database not connected")
-        return None
+    # get_all doesn't guarantee order - match snapshots back by path
+    snaps = {snap.reference.path: snap for snap in db.get_all([customer_ref, rest_ref])}
+    customer_snap = snaps.get(customer_ref.path)
+    rest_snap = snaps.get(rest_ref.path)
 
-    try:
-        rest_doc = db.collection('restaurants').document(restaurant_id).get()
+    customer = None
+    if customer_snap is not None and customer_snap.exists:
+        log.debug("Found existing customer: %s", customer_id)
+        customer = customer_snap.to_dict()
+    else:
+        log.debug("No customer found: %s", customer_id)
 
-        if rest_doc.exists:
-            code = rest_doc.to_dict().get('signup_code')
-            print(f"✅ Restaurant code found: {code}")
-            return code
-        else:
-            print(f"⚠️ No code set for restaurant: {restaurant_id}")
-            return None
-    except Exception as e:
-        print(f"❌ Error getting restaurant code: {e}")
-        return None
+    active_code = None
+    if rest_snap is not None and rest_snap.exists:
+        active_code = rest_snap.to_dict().get('signup_code')
 
+    return customer, active_code
 
-def validate_signup_code(code_entered, restaurant_id):
-    """Check if entered code matches restaurant's active code"""
-    active_code = get_restaurant_code(restaurant_id)
 
+def check_signup_code(code_entered, active_code):
+    """Compare entered code against an already-fetched active code"""
     if not active_code:
         return False, "No active code set for this restaurant"
 
     if code_entered.upper().strip() != active_code.upper().strip():
-        print(f"❌ Code mismatch: entered '{code_entered}' vs active '{active_code}'")
+        log.info("Code mismatch: entered %r vs active %r", code_entered, active_code)
         return False, "Invalid code"
 
-    print(f"✅ Code validated: {code_entered}")
+    log.debug("Code validated: %s", code_entered)
     return True, "Valid"
 
 
@@ -281,33 +378,33 @@ def get_signup_reward(code, restaurant_id):
         reward_snap = reward_ref.get()
 
         if not reward_snap.exists:
-            print(f"⚠️ No reward configured for code: {code}")
+            log.info("No reward configured for code: %s", code)
             return None
 
         reward_data = reward_snap.to_dict()
 
         # Check if active
         if reward_data.get('status') != 'active':
-            print(f"⚠️ Reward is not active: {code}")
+            log.info("Reward is not active: %s", code)
             return None
 
         # Random probability check
         win_probability = reward_data.get('win_probability', 0.5)  # Default 50%
         random_number = random.random()  # Generates 0.0 to 1.0
 
-        print(f"🎲 Random check: {random_number:.2f} vs {win_probability:.2f}")
+        log.debug("Random check: %.2f vs %.2f", random_number, win_probability)
 
         if random_number < win_probability:
             # WINNER!
-            print(f"✅ WINNER! Customer gets reward: {code}")
+            log.info("Reward won for code: %s", code)
             return reward_data
         else:
             # No luck this time
-            print(f"❌ No luck. Customer doesn't get reward: {code}")
+            log.info("No reward this time for code: %s", code)
             return None
 
     except Exception as e:
-        print(f"❌ Error getting reward: {e}")
+        log.error("Error getting reward: %s", e)
         return None
 
 
@@ -327,11 +424,11 @@ def increment_reward_usage(code, restaurant_id):
             'last_won_at': datetime.now(timezone.utc)
         })
 
-        print(f"✅ Reward stats updated for: {code}")
+        log.debug("Reward stats updated for: %s", code)
         return True
 
     except Exception as e:
-        print(f"❌ Error updating reward stats: {e}")
+        log.error("Error updating reward stats: %s", e)
         return False
 
 
@@ -352,21 +449,23 @@ def track_reward_attempt(code, restaurant_id):
         return True
 
     except Exception as e:
-        print(f"❌ Error tracking attempt: {e}")
+        log.error("Error tracking attempt: %s", e)
         return False
 
 
-def create_onboarding_customer(phone_number, code, restaurant_id):
-    """Create new customer (no reward stored in customer doc)"""
+def create_onboarding_customer(phone_clean, code, restaurant_id):
+    """Create new customer (no reward stored in customer doc)
+
+    phone_clean must already be cleaned (see clean_phone_number)
+    """
     if not db:
-        print("❌ Database not connected")
+        log.error("Database not connected")
         return False, None
     
     # Check for reward with random probability
     reward_data = get_signup_reward(code, restaurant_id)
     
     now = datetime.now(timezone.utc)
-    phone_clean = clean_phone_number(phone_number)
     customer_id = f"{phone_clean}_{restaurant_id}"
     
     try:
@@ -386,20 +485,138 @@ def create_onboarding_customer(phone_number, code, restaurant_id):
         else:
             track_reward_attempt(code, restaurant_id)
         
-        db.collection('customers').document(customer_id).set(customer_doc)
-        
-        db.collection('restaurants').document(restaurant_id).update({
+        # Customer doc + signup counter in one commit (one round trip, atomic)
+        batch = db.batch()
+        batch.set(db.collection('customers').document(customer_id), customer_doc)
+        batch.update(db.collection('restaurants').document(restaurant_id), {
             'total_signups': admin_firestore.Increment(1)
         })
+        batch.commit()
         
-        print(f"✅ Customer created: {customer_id} | Won: {reward_data is not None}")
+        log.info("Customer created: %s | Won: %s", customer_id, reward_data is not None)
         return True, reward_data
         
     except Exception as e:
-        print(f"❌ Error: {e}")
+        log.error("Error creating customer: %s", e)
         return False, None
 
 
+# ============================================================
+# Webhook Handlers
+# ============================================================
+
+# Webhook reply texts. The *_REWARD ones take reward_desc via .format().
+MSG_EXISTING_CUSTOMER = """Thanks for your message! 👋
+
+We'll keep you updated with exclusive offers soon! 🎁
+
+Need help? Contact our staff or visit us! 😊"""
+
+MSG_CODE_ALREADY_USED = """You've already used this code! ✅
+
+You're registered. Watch out for exclusive offers coming soon! 🎁"""
+
+MSG_NEW_CODE_REWARD = """🎉 New code registered!
+
+🎁 SPECIAL REWARD: {reward_desc}
+
+Show this message to the cashier to claim your reward!
+
+We'll keep sending you exclusive offers. Stay tuned! 📲"""
+
+MSG_NEW_CODE = """🎉 New code registered!
+
+You're all set! We'll keep sending you exclusive offers and updates.
+Stay tuned! 📲"""
+
+MSG_INVALID_CODE = """❌ Invalid code.
+
+Please ask the cashier for the correct signup code."""
+
+MSG_WELCOME_REWARD = """🎉 Welcome! You're registered!
+
+🎁 SPECIAL REWARD: {reward_desc}
+
+Show this message to the cashier to claim your reward!
+
+We'll also send you exclusive offers. Stay tuned! 📲"""
+
+MSG_WELCOME = """🎉 Welcome to our exclusive club!
+
+You're all set! We'll send you exclusive offers and updates soon.
+Stay tuned! 📲"""
+
+MSG_REGISTRATION_FAILED = "Sorry, registration failed. Please try again later."
+
+
+def _handle_existing_customer(from_number, customer, text_upper, active_code):
+    """CASE 1: Existing registered customer"""
+    # Check if they sent a signup code
+    is_valid_code, _ = check_signup_code(text_upper, active_code)
+
+    if not is_valid_code:
+        # Not a signup code - just a random message
+        log.info("Existing customer %s sent non-code message", from_number)
+        send_text_async(from_number, MSG_EXISTING_CUSTOMER, RESTAURANT_ID)
+        return
+
+    # Check if customer already signed up with THIS EXACT CODE
+    customer_signup_code = customer.get('signup_code', '').upper()
+
+    if customer_signup_code == text_upper:
+        # Customer trying to use the SAME code again
+        log.info("Customer %s already used code: %s", from_number, text_upper)
+        send_text_async(from_number, MSG_CODE_ALREADY_USED, RESTAURANT_ID)
+        return
+
+    # Customer entered a DIFFERENT valid code - treat as new signup!
+    log.info("Customer %s entered new code (old: %s, new: %s) - treating as new signup",
+             from_number, customer_signup_code, text_upper)
+
+    # Create customer and check for reward with NEW code
+    success, reward_data = create_onboarding_customer(from_number, text_upper, RESTAURANT_ID)
+
+    if success:
+        if reward_data:
+            # Customer got a reward with new code!
+            message_text = MSG_NEW_CODE_REWARD.format(reward_desc=reward_data['reward_description'])
+        else:
+            # No reward with new code
+            message_text = MSG_NEW_CODE
+
+        send_text_async(from_number, message_text, RESTAURANT_ID)
+    else:
+        log.error("Failed to update customer %s with new code", from_number)
+        send_text_async(from_number, MSG_REGISTRATION_FAILED, RESTAURANT_ID)
+
+
+def _handle_new_signup(from_number, text_clean, text_upper, active_code):
+    """CASE 2: New customer - validate signup code"""
+    # Validate signup code
+    is_valid, validation_message = check_signup_code(text_upper, active_code)
+    log.info("New customer %s signup code %r: %s", from_number, text_clean, validation_message)
+
+    if not is_valid:
+        send_text_async(from_number, MSG_INVALID_CODE, RESTAURANT_ID)
+        return
+
+    # Create customer and check for reward
+    success, reward_data = create_onboarding_customer(from_number, text_upper, RESTAURANT_ID)
+
+    if success:
+        if reward_data:
+            # Customer got a reward!
+            message_text = MSG_WELCOME_REWARD.format(reward_desc=reward_data['reward_description'])
+        else:
+            # No reward
+            message_text = MSG_WELCOME
+
+        send_text_async(from_number, message_text, RESTAURANT_ID)
+    else:
+        log.error("Failed to create customer %s", from_number)
+        send_text_async(from_number, MSG_REGISTRATION_FAILED, RESTAURANT_ID)
+
+
 # ============================================================
 # Flask Routes
 # ============================================================
@@ -417,10 +634,10 @@ def verify_webhook():
     challenge = request.args.get('hub.challenge')
 
     if mode == 'subscribe' and token == VERIFY_TOKEN:
-        print("✅ Webhook verified")
+        log.info("Webhook verified")
         return challenge, 200
     else:
-        print("❌ Webhook verification failed")
+        log.warning("Webhook verification failed")
         return "Forbidden", 403
 
 
@@ -429,10 +646,6 @@ def receive_message():
     """Receive messages from Meta WhatsApp - Onboarding Flow"""
     data = request.get_json()
 
-    print("=" * 60)
-    print("📨 Webhook received")
-    print("=" * 60)
-
     try:
         value = data['entry'][0]['changes'][0]['value']
 
@@ -441,8 +654,8 @@ def receive_message():
         incoming_phone_id = metadata.get('phone_number_id')
 
         if incoming_phone_id and incoming_phone_id != PHONE_NUMBER_ID:
-            print(f"⚠️ Message for different phone_number_id: {incoming_phone_id}")
-            print(f"   Expected: {PHONE_NUMBER_ID}")
+            log.warning("Message for different phone_number_id: %s (expected %s)",
+                        incoming_phone_id, PHONE_NUMBER_ID)
 
         if 'messages' in value:
             message = value['messages'][0]
@@ -450,163 +663,28 @@ def receive_message():
 
             if 'text' in message:
                 text = message['text']['body']
-                print(f"📱 From: {from_number}")
-                print(f"💬 Message: {text}")
+                log.info("Webhook message from %s: %r", from_number, text)
 
+                # Normalize once - handlers reuse these instead of re-stripping
                 text_clean = text.strip()
+                text_upper = text_clean.upper()
 
-                # Check if customer exists
-                print(f"🔍 Checking customer...")
-                customer = get_customer_by_phone_only(from_number, RESTAURANT_ID)
+                # Check if customer exists (signup code fetched in the same RPC)
+                customer, active_code = get_customer_and_signup_code(from_number, RESTAURANT_ID)
 
                 if customer:
-                    print(f"✅ Customer exists")
+                    _handle_existing_customer(from_number, customer, text_upper, active_code)
                 else:
-                    print(f"ℹ️ New customer - not in database")
-
-                # ========================================
-                # CASE 1: Existing customer
-                # ========================================
-                if customer:
-                    print(f"✅ CASE 1: Existing registered customer")
-
-                    # Check if they sent a signup code
-                    print(f"🔐 Checking if message is signup code...")
-                    is_valid_code, _ = validate_signup_code(text_clean, RESTAURANT_ID)
-
-                    if is_valid_code:
-                        # Check if customer already signed up with THIS EXACT CODE
-                        customer_signup_code = customer.get('signup_code', '').upper()
-                        entered_code = text_clean.upper()
-
-                        if customer_signup_code == entered_code:
-                            # Customer trying to use the SAME code again
-                            print(f"⚠️ Customer already used this exact code: {entered_code}")
-                            message_text = """You've already used this code! ✅
-
-You're registered. Watch out for exclusive offers coming soon! 🎁"""
-
-                            print("📤 Sending 'already used' message")
-                            send_text(from_number, message_text, RESTAURANT_ID)
-                            print("✅ Message sent successfully!")
-                            return jsonify({"status": "ok"}), 200
-                        else:
-                            # Customer entered a DIFFERENT valid code - treat as new signup!
-                            print(f"🆕 Customer entered NEW code. Old: {customer_signup_code}, New: {entered_code}")
-                            print(f"   → Treating as new signup with new code")
-
-                            # Create customer and check for reward with NEW code
-                            success, reward_data = create_onboarding_customer(
-                                from_number, 
-                                text_clean.upper(), 
-                                RESTAURANT_ID
-                            )
-
-                            if success:
-                                if reward_data:
-                                    # Customer got a reward with new code!
-                                    reward_desc = reward_data['reward_description']
-                                    message_text = f"""🎉 New code registered!
-
-🎁 SPECIAL REWARD: {reward_desc}
-
-Show this message to the cashier to claim your reward!
-
-We'll keep sending you exclusive offers. Stay tuned! 📲"""
-                                else:
-                                    # No reward with new code
-                                    message_text = """🎉 New code registered!
-
-You're all set! We'll keep sending you exclusive offers and updates.
-Stay tuned! 📲"""
-
-                                print("📤 Sending new code welcome message")
-                                send_text(from_number, message_text, RESTAURANT_ID)
-                                print("✅ Message sent successfully!")
-                            else:
-                                print("❌ Failed to update customer with new code")
-                                send_text(from_number, "Sorry, registration failed. Please try again later.", RESTAURANT_ID)
-
-                            return jsonify({"status": "ok"}), 200
-                    else:
-                        # Not a signup code - just a random message
-                        print(f"ℹ️ Customer sent random message: '{text_clean}'")
-                        message_text = """Thanks for your message! 👋
-
-We'll keep you updated with exclusive offers soon! 🎁
-
-Need help? Contact our staff or visit us! 😊"""
-
-                        print("📤 Sending response to existing customer")
-                        send_text(from_number, message_text, RESTAURANT_ID)
-                        print("✅ Message sent successfully!")
-                        return jsonify({"status": "ok"}), 200
-
-                # ========================================
-                # CASE 2: New customer - validate signup code
-                # ========================================
-                else:
-                    print(f"🆕 CASE 2: New customer attempting signup")
-
-                    # Validate signup code
-                    print(f"🔐 Validating code: '{text_clean}'")
-                    is_valid, validation_message = validate_signup_code(text_clean, RESTAURANT_ID)
-                    print(f"   Validation result: {is_valid} - {validation_message}")
-
-                    if is_valid:
-                        print(f"✅ Valid code! Creating customer...")
-
-                        # Create customer and check for reward
-                        success, reward_data = create_onboarding_customer(
-                            from_number, 
-                            text_clean.upper(), 
-                            RESTAURANT_ID
-                        )
-
-                        if success:
-                            if reward_data:
-                                # Customer got a reward!
-                                reward_desc = reward_data['reward_description']
-                                message_text = f"""🎉 Welcome! You're registered!
-
-🎁 SPECIAL REWARD: {reward_desc}
-
-Show this message to the cashier to claim your reward!
-
-We'll also send you exclusive offers. Stay tuned! 📲"""
-                            else:
-                                # No reward
-                                message_text = """🎉 Welcome to our exclusive club!
-
-You're all set! We'll send you exclusive offers and updates soon.
-Stay tuned! 📲"""
-
-                            print("📤 Sending welcome message")
-                            send_text(from_number, message_text, RESTAURANT_ID)
-                            print("✅ Message sent successfully!")
-                        else:
-                            print("❌ Failed to create customer")
-                            send_text(from_number, "Sorry, registration failed. Please try again later.", RESTAURANT_ID)
-                    else:
-                        print(f"❌ Invalid code entered")
-                        message_text = """❌ Invalid code.
-
-Please ask the cashier for the correct signup code."""
-                        print("📤 Sending invalid code message")
-                        send_text(from_number, message_text, RESTAURANT_ID)
-                        print("✅ Message sent successfully!")
-
-                    return jsonify({"status": "ok"}), 200
+                    _handle_new_signup(from_number, text_clean, text_upper, active_code)
+                return jsonify({"status": "ok"}), 200
 
         elif 'statuses' in value:
             status = value['statuses'][0]
-            print(f"📊 Status update: {status.get('status')}")
+            log.debug("Status update: %s", status.get('status'))
             return jsonify({"status": "ok"}), 200
 
     except Exception as e:
-        print(f"❌ ERROR in webhook: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("Error in webhook: %s", e)
         return jsonify({"status": "error", "message": str(e)}), 500
 
     return jsonify({"status": "ok"}), 200
@@ -639,42 +717,82 @@ def send_template_campaign():
     if not template_name:
         return jsonify({"error": "template_name is required"}), 400
 
-    # Get restaurant name from Firestore
-    rest_doc = db.collection('restaurants').document(restaurant_id).get()
-    if rest_doc.exists:
-        restaurant_name = rest_doc.to_dict().get('restaurant_name', "Our Restaurant")
+    # Get restaurant name from Firestore (cached)
+    restaurant = get_restaurant(restaurant_id)
+    if restaurant is not None:
+        restaurant_name = restaurant.get('restaurant_name', "Our Restaurant")
     else:
         restaurant_name = "Our Restaurant"
 
-    # Get customers
-    customers = get_customers_by_segment(segment, restaurant_id)
-    total = len(customers)
+    # Build params for template
+    params = [restaurant_name]  # {{1}}
 
-    if total == 0:
-        return jsonify({"success": False, "message": "No customers found"}), 200
-
-    sent, failed = 0, 0
+    # Stream customers onto the campaign pool - sending starts with the first page
+    # instead of the full list, and sends overlap instead of running one by one.
+    # Submissions block once CAMPAIGN_QUEUE_DEPTH sends are pending and results are
+    # tallied as each send finishes, so memory stays flat for any segment size.
+    total = 0
+    counts = {"sent": 0, "failed": 0}
+    counts_lock = threading.Lock()
+    slots = threading.BoundedSemaphore(CAMPAIGN_QUEUE_DEPTH)
+    stream_error = None
 
-    for cust in customers:
+    def _tally(future):
         try:
-            # Build params for template
-            params = [restaurant_name]  # {{1}}
-
-            # Send template message
-            result = send_template_message(
-                cust["phone_number"],
-                template_name,
-                params
-            )
-
-            if "messages" in result:
-                sent += 1
-            else:
-                failed += 1
-
+            key = "sent" if "messages" in future.result() else "failed"
         except Exception as err:
-            print("Error sending:", err)
-            failed += 1
+            log.error("Error sending: %s", err)
+            key = "failed"
+
+        with counts_lock:
+            counts[key] += 1
+        slots.release()
+
+    try:
+        for cust in get_customers_by_segment(segment, restaurant_id):
+            total += 1
+            slots.acquire()
+            try:
+                future = _campaign_pool.submit(
+                    send_template_message,
+                    cust["phone_number"],
+                    template_name,
+                    params
+                )
+            except Exception as err:
+                slots.release()
+                log.error("Error sending: %s", err)
+                with counts_lock:
+                    counts["failed"] += 1
+                continue
+
+            future.add_done_callback(_tally)
+    except Exception as err:
+        # Firestore failed mid-stream: let already-queued sends finish, then
+        # report the partial run instead of a short "success"
+        log.exception("Error streaming customers: %s", err)
+        stream_error = str(err)
+
+    # Wait for pending sends - every slot is free again once all callbacks ran
+    for _ in range(CAMPAIGN_QUEUE_DEPTH):
+        slots.acquire()
+
+    sent, failed = counts["sent"], counts["failed"]
+
+    if stream_error is not None:
+        return jsonify({
+            "success": False,
+            "error": f"Customer stream failed: {stream_error}",
+            "template": template_name,
+            "segment": segment,
+            "restaurant_name": restaurant_name,
+            "total_customers": total,
+            "sent": sent,
+            "failed": failed
+        }), 500
+
+    if total == 0:
+        return jsonify({"success": False, "message": "No customers found"}), 200
 
     return jsonify({
         "success": True,
@@ -691,6 +809,7 @@ def send_template_campaign():
 # Run Flask App
 # ============================================================
 
+# Local development only - production runs under gunicorn (see Procfile)
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)